@@ -1,21 +1,32 @@
 #!/usr/bin/env python3
 
+import asyncio
+import hashlib
 import os
-import time
 import io
 import logging
-import tempfile
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import json
+from functools import lru_cache
 
+import aiohttp
+import httplib2
 import requests
-from PIL import Image, ImageEnhance, ImageChops
-from pdf2image import convert_from_bytes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fitz
+import numpy as np
+from PIL import Image, ImageFilter
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import TransportError
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
+Image.preinit()
+Image.MAX_IMAGE_PIXELS = 300_000_000
 
 SHEET_ID = os.getenv("SHEET_ID")
 SHEET_NAME = "VD Top Batch Day View"
@@ -31,12 +42,41 @@ UPLOAD_URL = f"https://api.cloudinary.com/v1_1/{CLOUD_NAME}/image/upload"
 
 AISENSY_API_KEY = os.getenv("AISENSY_API_KEY")
 CAMPAIGN_NAME = os.getenv("AISENSY_CAMPAIGN_NAME")
+AISENSY_URL = "https://backend.aisensy.com/campaign/t1/api"
+AISENSY_CONCURRENCY = 8
+# AiSensy does not publish a per-second limit for the campaign API; the
+# defaults keep the original script's one send every 5 s until a higher
+# rate has been confirmed for the account
+AISENSY_RATE_PER_SEC = float(os.getenv("AISENSY_RATE_PER_SEC", "0.2"))
+AISENSY_SEND_GAP_SEC = float(os.getenv("AISENSY_SEND_GAP_SEC", "5"))
+AISENSY_CONNECT_RETRIES = 3
 DESTINATIONS = [d.strip() for d in os.getenv("DESTINATIONS", "").split(",") if d.strip()]
 
 TODAY = datetime.now().strftime("%d %B %Y")
 
+# only useful on a host whose filesystem survives between runs (e.g. a
+# persistent volume on the worker); GitHub Actions runners start empty, and
+# the bearer token must not be put in actions/cache, so leave unset there
+TOKEN_CACHE_PATH = os.getenv("GOOGLE_TOKEN_CACHE")
+TOKEN_MIN_TTL = timedelta(seconds=60)
+# must point somewhere that persists between runs (the workflow restores it
+# with actions/cache); when unset, every range is exported on every run
+EXPORT_CACHE_PATH = os.getenv("EXPORT_CACHE_PATH")
+
 TARGET_SIZE_BYTES = 4 * 1024 * 1024
-JPEG_QUALITIES = [95, 85, 75, 65, 55]
+MAX_IMAGE_DIM = 2400
+JPEG_QUALITY_MIN = 55
+JPEG_QUALITY_MAX = 95
+JPEG_SUBSAMPLING = 2  # 4:2:0
+JPEG_QTABLES = None  # libjpeg defaults; set to tuned tables to override
+
+BG = (255, 255, 255)
+# render straight at the output size; anything larger is thrown away by the
+# MAX_IMAGE_DIM downscale after cropping
+RENDER_WIDTH_PX = MAX_IMAGE_DIM
+MAX_RENDER_DPI = 300
+
+IO_WORKERS = 4
 
 logging.basicConfig(
     level=logging.INFO,
@@ -44,52 +84,322 @@ logging.basicConfig(
 )
 logger = logging.getLogger("bizcat")
 
+def build_session() -> requests.Session:
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+SESSION = build_session()
+
+def load_cached_token(creds: Credentials):
+    if not TOKEN_CACHE_PATH:
+        return
+
+    try:
+        with open(TOKEN_CACHE_PATH) as f:
+            cached = json.load(f)
+        account, token = cached["account"], cached["token"]
+        expiry = datetime.fromisoformat(cached["expiry"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return
+
+    if account != creds.service_account_email:
+        return
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if expiry - now > TOKEN_MIN_TTL:
+        creds.token = token
+        creds.expiry = expiry
+        logger.info("using cached google token")
+
+def save_cached_token(creds: Credentials):
+    if not TOKEN_CACHE_PATH:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_PATH) or ".", exist_ok=True)
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "account": creds.service_account_email,
+                    "token": creds.token,
+                    "expiry": creds.expiry.isoformat(),
+                },
+                f,
+            )
+    except OSError as e:
+        logger.warning("could not cache google token: %s", e)
+
 def refresh_creds(creds: Credentials):
+    if not creds.valid:
+        load_cached_token(creds)
     if not creds.valid:
         creds.refresh(Request())
         logger.info("google token refreshed")
+        save_cached_token(creds)
+
+@lru_cache(maxsize=None)
+def get_sheets_service(creds: Credentials):
+    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+
+@lru_cache(maxsize=None)
+def get_sheet_gid_map(creds: Credentials, spreadsheet_id: str = SHEET_ID) -> dict:
+    meta = (
+        get_sheets_service(creds)
+        .spreadsheets()
+        .get(spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)")
+        .execute()
+    )
+    return {
+        sheet["properties"]["title"]: str(sheet["properties"]["sheetId"])
+        for sheet in meta["sheets"]
+    }
+
+@lru_cache(maxsize=None)
+def get_drive_service(creds: Credentials):
+    return build("drive", "v3", credentials=creds, cache_discovery=False)
 
 def get_sheet_gid(creds: Credentials, sheet_name: str) -> str:
-    service = build("sheets", "v4", credentials=creds)
-    meta = service.spreadsheets().get(spreadsheetId=SHEET_ID).execute()
-    for sheet in meta["sheets"]:
-        props = sheet["properties"]
-        if props["title"] == sheet_name:
-            return str(props["sheetId"])
-    raise RuntimeError(f"sheet {sheet_name} not found")
-
-def jpg_bytes(img: Image.Image, quality: int) -> bytes:
+    gid_map = get_sheet_gid_map(creds)
+    if sheet_name not in gid_map:
+        raise RuntimeError(f"sheet {sheet_name} not found")
+    return gid_map[sheet_name]
+
+def jpg_bytes_fast(img: Image.Image, quality: int) -> bytes:
     buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    img.save(buf, format="JPEG", quality=quality, optimize=False, progressive=False)
     return buf.getvalue()
 
+def jpg_bytes_final(
+    img: Image.Image,
+    quality: int,
+    subsampling: int = JPEG_SUBSAMPLING,
+    qtables=JPEG_QTABLES,
+) -> bytes:
+    buf = io.BytesIO()
+    options = {"quality": quality, "subsampling": subsampling}
+    if qtables is not None:
+        options["qtables"] = qtables
+    img.save(buf, format="JPEG", optimize=True, progressive=True, **options)
+    return buf.getvalue()
+
+def best_jpeg_quality(img: Image.Image) -> Optional[int]:
+    # most exports fit at the top quality, so try that before bisecting
+    size = len(jpg_bytes_fast(img, JPEG_QUALITY_MAX))
+    logger.info("jpeg quality %s size %.2f MB", JPEG_QUALITY_MAX, size / 1024 / 1024)
+    if size <= TARGET_SIZE_BYTES:
+        return JPEG_QUALITY_MAX
+
+    lo, hi = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX - 1
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        size = len(jpg_bytes_fast(img, mid))
+        logger.info("jpeg quality %s size %.2f MB", mid, size / 1024 / 1024)
+        if size <= TARGET_SIZE_BYTES:
+            best = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best
+
 def optimize_image(img: Image.Image) -> bytes:
-    if img.mode != "RGB":
-        img = img.convert("RGB")
+    assert img.mode == "RGB", img.mode
 
-    for q in JPEG_QUALITIES:
-        data = jpg_bytes(img, q)
-        logger.info("jpeg quality %s size %.2f MB", q, len(data) / 1024 / 1024)
-        if len(data) <= TARGET_SIZE_BYTES:
-            return data
+    quality = best_jpeg_quality(img)
+    if quality is not None:
+        return jpg_bytes_final(img, quality)
 
     w, h = img.size
     for _ in range(3):
         w = int(w * 0.96)
         h = int(h * 0.96)
         img = img.resize((w, h), Image.LANCZOS)
-        data = jpg_bytes(img, 65)
+        data = jpg_bytes_fast(img, 65)
         if len(data) <= TARGET_SIZE_BYTES:
-            return data
+            return jpg_bytes_final(img, 65)
+
+    return jpg_bytes_final(img, 65)
+
+@lru_cache(maxsize=None)
+def render_matrix(page_width_pt: float) -> fitz.Matrix:
+    zoom = min(MAX_RENDER_DPI, round(RENDER_WIDTH_PX * 72 / page_width_pt)) / 72
+    return fitz.Matrix(zoom, zoom)
+
+def crop_white_space(arr: np.ndarray) -> Optional[np.ndarray]:
+    mask = (arr != BG).any(axis=2)
+    rows = mask.any(axis=1)
+    cols = mask.any(axis=0)
+    if not rows.any():
+        return None
+    top = int(rows.argmax())
+    bottom = len(rows) - int(rows[::-1].argmax())
+    left = int(cols.argmax())
+    right = len(cols) - int(cols[::-1].argmax())
+    return arr[top:bottom, left:right]
+
+def stack_vertically(parts: List[np.ndarray]) -> np.ndarray:
+    if len(parts) == 1:
+        return parts[0]
+    width = max(p.shape[1] for p in parts)
+    out = np.full((sum(p.shape[0] for p in parts), width, 3), BG, dtype=np.uint8)
+    y = 0
+    for p in parts:
+        out[y:y + p.shape[0], :p.shape[1]] = p
+        y += p.shape[0]
+    return out
+
+def download_range_pdf(creds: Credentials, sheet_gid: str, sheet_range: str) -> bytes:
+    range_only = sheet_range.split("!")[1]
+
+    export_url = (
+        f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/export"
+        f"?format=pdf"
+        f"&portrait=false"
+        f"&gid={sheet_gid}"
+        f"&range={range_only}"
+        f"&size=A2"
+        f"&scale=4"
+        f"&top_margin=0.25"
+        f"&bottom_margin=0.25"
+        f"&left_margin=0.25"
+        f"&right_margin=0.25"
+    )
 
-    return data
+    logger.info("exporting range %s", sheet_range)
 
-def crop_white_space(img: Image.Image) -> Image.Image:
-    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
-    diff = ImageChops.difference(img, bg)
-    diff = ImageEnhance.Contrast(diff).enhance(3.0)
-    bbox = diff.getbbox()
-    return img.crop(bbox) if bbox else img
+    response = SESSION.get(
+        export_url,
+        headers={"Authorization": f"Bearer {creds.token}"},
+        timeout=90,
+    )
+    response.raise_for_status()
+    return response.content
+
+def render_range_image(pdf_data: bytes) -> bytes:
+    # arrays are views into the pixmap buffers, so keep pixmaps alive until
+    # the PIL image has been built
+    pixmaps = []
+    parts = []
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        if doc.page_count > 1:
+            logger.info("export spans %s pages, stacking", doc.page_count)
+        for page in doc:
+            pix = page.get_pixmap(
+                matrix=render_matrix(page.rect.width),
+                alpha=False,
+                colorspace=fitz.csRGB,
+            )
+            pixmaps.append(pix)
+            arr = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+            cropped = crop_white_space(arr)
+            if cropped is not None:
+                parts.append(cropped)
+
+    # blank overflow pages are dropped; keep the first raster if all are blank
+    if not parts:
+        logger.warning("export rendered blank")
+        pix = pixmaps[0]
+        parts.append(np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3))
+
+    img = Image.fromarray(stack_vertically(parts))
+    del parts, pixmaps
+
+    # downscale before sharpening so the filter isn't averaged away by the resize
+    if max(img.size) > MAX_IMAGE_DIM:
+        scale = MAX_IMAGE_DIM / max(img.size)
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    img = img.filter(ImageFilter.UnsharpMask(radius=1.5, percent=150, threshold=3))
+
+    return optimize_image(img)
+
+def upload_image(i: int, jpg_data: bytes) -> Optional[str]:
+    upload = SESSION.post(
+        UPLOAD_URL,
+        files={"file": (f"table_{i}.jpg", jpg_data, "image/jpeg")},
+        data={
+            "upload_preset": UPLOAD_PRESET,
+            "folder": f"BizCat_Exports/{datetime.now().strftime('%Y-%m-%d')}",
+        },
+        timeout=60,
+    )
+    upload.raise_for_status()
+
+    url = upload.json().get("secure_url")
+    if url:
+        logger.info("uploaded %s", url)
+    return url
+
+def get_range_fingerprints(creds: Credentials) -> Optional[List[str]]:
+    try:
+        modified = (
+            get_drive_service(creds)
+            .files()
+            .get(fileId=SHEET_ID, fields="modifiedTime", supportsAllDrives=True)
+            .execute()["modifiedTime"]
+        )
+        value_ranges = (
+            get_sheets_service(creds)
+            .spreadsheets()
+            .values()
+            .batchGet(spreadsheetId=SHEET_ID, ranges=RANGES)
+            .execute()["valueRanges"]
+        )
+    except (HttpError, TransportError, httplib2.HttpLib2Error, OSError) as e:
+        logger.warning("could not fingerprint ranges, exporting all: %s", e)
+        return None
+
+    return [
+        f"{modified}:" + hashlib.sha256(json.dumps(vr.get("values", [])).encode()).hexdigest()
+        for vr in value_ranges
+    ]
+
+def load_export_cache() -> dict:
+    try:
+        with open(EXPORT_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_export_cache(cache: dict):
+    try:
+        os.makedirs(os.path.dirname(EXPORT_CACHE_PATH) or ".", exist_ok=True)
+        with open(EXPORT_CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logger.warning("could not save export cache: %s", e)
+
+def export_ranges(creds: Credentials, ranges: List[Tuple[int, str]]) -> List[Optional[str]]:
+    sheet_gid = get_sheet_gid(creds, SHEET_NAME)
+    logger.info("using sheet %s gid=%s", SHEET_NAME, sheet_gid)
+
+    # download -> render -> upload, each stage on its own executor so network
+    # and CPU work for different ranges overlap. Downloads and uploads run
+    # concurrently per range; PyMuPDF is not thread-safe, so rendering stays
+    # on a single thread
+    io_workers = min(len(ranges), IO_WORKERS)
+    with ThreadPoolExecutor(max_workers=io_workers) as downloader, \
+            ThreadPoolExecutor(max_workers=1) as renderer, \
+            ThreadPoolExecutor(max_workers=io_workers) as uploader:
+        downloads = [
+            downloader.submit(download_range_pdf, creds, sheet_gid, sheet_range)
+            for _, sheet_range in ranges
+        ]
+        renders = [renderer.submit(render_range_image, d.result()) for d in downloads]
+        uploads = [
+            uploader.submit(upload_image, i, r.result())
+            for (i, _), r in zip(ranges, renders)
+        ]
+        return [u.result() for u in uploads]
 
 def export_and_upload_images() -> List[str]:
     creds_info = json.loads(os.getenv("GOOGLE_CREDENTIALS_JSON"))
@@ -103,85 +413,80 @@ def export_and_upload_images() -> List[str]:
     )
 
     refresh_creds(creds)
-    sheet_gid = get_sheet_gid(creds, SHEET_NAME)
-    logger.info("using sheet %s gid=%s", SHEET_NAME, sheet_gid)
-
-    uploaded_urls = []
-
-    for i, sheet_range in enumerate(RANGES, start=1):
-        range_only = sheet_range.split("!")[1]
-
-        export_url = (
-            f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/export"
-            f"?format=pdf"
-            f"&portrait=false"
-            f"&gid={sheet_gid}"
-            f"&range={range_only}"
-            f"&size=A2"
-            f"&scale=4"
-            f"&top_margin=0.25"
-            f"&bottom_margin=0.25"
-            f"&left_margin=0.25"
-            f"&right_margin=0.25"
-        )
-
-        logger.info("exporting range %s", sheet_range)
-
-        response = requests.get(
-            export_url,
-            headers={"Authorization": f"Bearer {creds.token}"},
-            timeout=90,
-        )
-        response.raise_for_status()
-
-        pages = convert_from_bytes(
-            response.content,
-            dpi=300,
-            first_page=1,
-            last_page=1,
-        )
-
-        img = pages[0].convert("RGB")
-        img = ImageEnhance.Sharpness(img).enhance(2.0)
-        img = crop_white_space(img)
-
-        jpg_data = optimize_image(img)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_table_{i}.jpg") as tmp:
-            tmp.write(jpg_data)
-            filename = tmp.name
 
+    if not EXPORT_CACHE_PATH:
+        return [url for url in export_ranges(creds, list(enumerate(RANGES, start=1))) if url]
+
+    fingerprints = get_range_fingerprints(creds) or [None] * len(RANGES)
+    cache = load_export_cache()
+    urls = {}
+    stale = []
+
+    for i, (sheet_range, fingerprint) in enumerate(zip(RANGES, fingerprints), start=1):
+        hit = cache.get(sheet_range, {})
+        if fingerprint and hit.get("fingerprint") == fingerprint and hit.get("url"):
+            urls[sheet_range] = hit["url"]
+            logger.info("range %s unchanged, reusing %s", sheet_range, hit["url"])
+        else:
+            stale.append((i, sheet_range))
+
+    if stale:
+        for (i, sheet_range), url in zip(stale, export_ranges(creds, stale)):
+            urls[sheet_range] = url
+            fingerprint = fingerprints[i - 1]
+            if url and fingerprint:
+                cache[sheet_range] = {"fingerprint": fingerprint, "url": url}
+        save_export_cache(cache)
+
+    return [urls[r] for r in RANGES if urls.get(r)]
+
+class RateLimiter:
+    def __init__(self, rate_per_sec: float):
+        if rate_per_sec <= 0:
+            raise ValueError(f"rate must be positive, got {rate_per_sec}")
+        self.interval = 1 / rate_per_sec
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def post_with_retry(
+    session: aiohttp.ClientSession,
+    limiter: RateLimiter,
+    payload: dict,
+) -> int:
+    # only connection failures are retried: the request never reached
+    # AiSensy, so resending cannot duplicate a message
+    for attempt in range(AISENSY_CONNECT_RETRIES + 1):
+        await limiter.wait()
         try:
-            with open(filename, "rb") as f:
-                upload = requests.post(
-                    UPLOAD_URL,
-                    files={"file": f},
-                    data={
-                        "upload_preset": UPLOAD_PRESET,
-                        "folder": f"BizCat_Exports/{datetime.now().strftime('%Y-%m-%d')}",
-                    },
-                    timeout=60,
-                )
-                upload.raise_for_status()
-
-            url = upload.json().get("secure_url")
-            if url:
-                uploaded_urls.append(url)
-                logger.info("uploaded %s", url)
-        finally:
-            os.remove(filename)
-
-        time.sleep(2)
-
-    return uploaded_urls
-
-def send_via_aisensy(urls: List[str]):
-    if not urls:
-        logger.warning("no images generated")
-        return
-
-    for dest in DESTINATIONS:
+            async with session.post(AISENSY_URL, json=payload) as r:
+                return r.status
+        except aiohttp.ClientConnectorError:
+            if attempt == AISENSY_CONNECT_RETRIES:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+async def send_to_destination(
+    session: aiohttp.ClientSession,
+    slots: asyncio.Semaphore,
+    limiter: RateLimiter,
+    dest: str,
+    urls: List[str],
+):
+    # images for one recipient go out in order, spaced like the original
+    # serial loop, so WhatsApp delivers table_1 before table_2
+    async with slots:
         for i, url in enumerate(urls, start=1):
+            if i > 1:
+                await asyncio.sleep(AISENSY_SEND_GAP_SEC)
+
             payload = {
                 "apiKey": AISENSY_API_KEY,
                 "campaignName": CAMPAIGN_NAME,
@@ -192,13 +497,33 @@ def send_via_aisensy(urls: List[str]):
                 "media": {"url": url, "filename": f"table_{i}.jpg"},
             }
 
-            r = requests.post(
-                "https://backend.aisensy.com/campaign/t1/api",
-                json=payload,
-                timeout=30,
-            )
-            logger.info("sent to %s image %s status %s", dest, i, r.status_code)
-            time.sleep(5)
+            try:
+                status = await post_with_retry(session, limiter, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("sent to %s image %s failed: %r", dest, i, e)
+                continue
+            logger.info("sent to %s image %s status %s", dest, i, status)
+
+async def send_all(urls: List[str]):
+    slots = asyncio.Semaphore(AISENSY_CONCURRENCY)
+    limiter = RateLimiter(AISENSY_RATE_PER_SEC)
+    connector = aiohttp.TCPConnector(limit=AISENSY_CONCURRENCY, keepalive_timeout=30)
+
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30),
+    ) as session:
+        await asyncio.gather(*(
+            send_to_destination(session, slots, limiter, dest, urls)
+            for dest in DESTINATIONS
+        ))
+
+def send_via_aisensy(urls: List[str]):
+    if not urls:
+        logger.warning("no images generated")
+        return
+
+    asyncio.run(send_all(urls))
 
 if __name__ == "__main__":
     required = [
@@ -213,8 +538,8 @@ if __name__ == "__main__":
     if missing:
         raise EnvironmentError(f"missing secrets: {', '.join(missing)}")
 
-
-    Image.MAX_IMAGE_PIXELS = 300_000_000
+    if AISENSY_RATE_PER_SEC <= 0:
+        raise EnvironmentError(f"AISENSY_RATE_PER_SEC must be positive, got {AISENSY_RATE_PER_SEC}")
 
     logger.info("automation started")
     urls = export_and_upload_images()